@@ -1,9 +1,36 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import atexit
+import functools
+import hashlib
+import itertools
+import json
 import os
-import random
-from typing import List, Optional
+import queue
+import secrets
+import shutil
+import sys
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, TypeVar, Union
+
+try:
+    import readline  # Enables line editing in input() on terminals that support it.
+except ImportError:
+    pass
+
+import msgpack
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential, wait_random
 
-import vertexai
-from vertexai.preview.vision_models import ImageGenerationModel, Image
+# The Vertex AI SDK, google-auth and numpy take most of the startup time, so
+# they are imported where they are first used rather than at module load.
+if TYPE_CHECKING:
+    import numpy as np
+    from vertexai.language_models import TextEmbeddingModel
+    from vertexai.preview.vision_models import ImageGenerationModel, Image
 
 # --- Configuration ---
 # IMPORTANT: Set these environment variables before running the script.
@@ -22,67 +49,741 @@ except KeyError:
 # Parameters from Functional_Spec.md
 MODEL_NAME = "imagen-4.0-ultra-generate-001"
 FIXED_ASPECT_RATIO = "16:9"
-FIXED_SAMPLE_COUNT = 1
+# The target model accepts a sampleCount of 1-4 per request.
+MAX_SAMPLE_COUNT = 4
+
+# Prediction calls use gRPC, which carries image bytes as raw protobuf fields
+# instead of base64 inside JSON. Set VERTEX_API_TRANSPORT=rest if gRPC is blocked.
+API_TRANSPORT = os.environ.get("VERTEX_API_TRANSPORT", "grpc")
+
+# Images restored from the cache are written from their raw bytes through a
+# 1 MiB buffer. Freshly generated images are not: they go through the SDK's
+# `save`, which re-encodes them to embed their generation parameters as EXIF.
+# Set IMAGEN_FSYNC=1 to fsync each image before it is reported as saved.
+WRITE_BUFFER_SIZE = 1 << 20
+FSYNC_IMAGES = os.environ.get("IMAGEN_FSYNC") == "1"
+
+# Character Packages are persisted here so a restarted CLI can reuse them
+# without regenerating their portraits.
+SESSION_FILE = ".cinegen_session.mpk"
+
+# Caps the number of in-flight Imagen requests so batch fan-out stays within
+# quota. Transient failures (429, 503, deadline exceeded) are retried with
+# jittered exponential backoff; any other error fails immediately.
+IMAGEN_CONCURRENCY = int(os.environ.get("IMAGEN_CONCURRENCY", "5"))
+IMAGEN_MAX_ATTEMPTS = 3
+
+# Generated images are cached on disk, keyed by the request parameters, so an
+# identical request is served from a local copy instead of the API.
+CACHE_DIR = ".imagen_cache"
+CACHE_MAX_ENTRIES = 500
+
+# Near-duplicate scene prompts (same seed and negative prompt) can reuse a
+# cached scene when the cosine similarity of their embeddings reaches this threshold.
+# Scenes of one character share its seed and long description, so they embed as
+# near-duplicates even when the action differs; the cache is therefore off
+# unless IMAGEN_SEMANTIC_CACHE_THRESHOLD is set to a value in (0, 1].
+EMBEDDING_MODEL_NAME = "text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("IMAGEN_SEMANTIC_CACHE_THRESHOLD", "0"))
+
+# Character names become part of output filenames, so characters that are
+# invalid in filenames on common platforms are rejected.
+_INVALID_NAME_CHARS = frozenset('/\\:*?"<>|\n\t')
+
+T = TypeVar("T")
+
+def validate_character_name(name: str) -> Tuple[bool, str]:
+    """Checks that a character name can be used in output filenames."""
+    if not name.strip():
+        return False, "Character name cannot be empty"
+    bad = set(name) & _INVALID_NAME_CHARS
+    if bad:
+        return False, f"Character name contains invalid character: {next(iter(bad))!r}"
+    return True, ""
+
+# Prompt templates, bound once at import time.
+_PORTRAIT_TMPL = "cinematic portrait, high detail, studio lighting. {}".format
+_SCENE_PREFIX_TMPL = "{}. ".format
+
+def portrait_prompt(description: str) -> str:
+    """Builds the Stage 1 portrait prompt with quality modifiers."""
+    return _PORTRAIT_TMPL(description.strip())
+
+def file_stem(name: str) -> str:
+    """Returns the filename-safe form of a character name used for its output files."""
+    return name.strip().replace(' ', '_')
+
+def session_key(name: str) -> str:
+    """
+    Returns the key a character is stored under in the session. Names that map
+    to the same output files (e.g. "Bob", "bob " and "BOB") share a key.
+    """
+    return file_stem(name).lower()
+
+class ImagenError(Exception):
+    """Raised when an Imagen request completes without producing an image."""
 
 class CharacterPackage:
     """A class to hold the data for a consistent character, per the spec."""
-    def __init__(self, name: str, description: str, seed: int, negative_prompt: Optional[str] = None):
+    __slots__ = (
+        "name", "description", "seed", "negative_prompt", "portrait",
+        "safe_name", "stage1_prompt", "scene_prefix",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        seed: int,
+        negative_prompt: Optional[str] = None,
+        portrait: Optional[str] = None
+    ):
         self.name = name
         self.description = description
         self.seed = seed
         self.negative_prompt = negative_prompt
+        # Prompt fragments and the filename stem are built once; scenes only
+        # append their own description.
+        self.safe_name = file_stem(name)
+        self.portrait = portrait or f"{self.safe_name}_portrait.png"
+        self.stage1_prompt = portrait_prompt(description)
+        self.scene_prefix = _SCENE_PREFIX_TMPL(description.strip())
 
     def __str__(self):
         return f"'{self.name}': {self.description[:70]}..."
 
-def generate_image(
+class PromptCache:
+    """An in-memory approximate cache of prompt embeddings and the images they produced."""
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._embedding_model = None
+        # Rows are unit-normalized, so a single matrix-vector product yields cosine similarities.
+        self._embeddings: Optional[np.ndarray] = None
+        self._keys: List[Tuple[int, str]] = []
+        self._key_set: Set[Tuple[int, str]] = set()
+        self._paths: List[str] = []
+        # Entries are added from a background thread while lookups run on the event loop.
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.threshold <= 1
+
+    def has_entries(self, seed: int, negative_prompt: Optional[str]) -> bool:
+        """Returns True if an image with this seed and negative prompt has been recorded."""
+        return self.enabled and (seed, negative_prompt or "") in self._key_set
+
+    def _get_embedding_model(self) -> TextEmbeddingModel:
+        """
+        Returns the embedding model, loading it on first use. Embeddings are
+        computed on worker threads, so the load is guarded by the init lock to
+        build a single client that every later call reuses.
+        """
+        if self._embedding_model is None:
+            with _init_lock:
+                if self._embedding_model is None:
+                    _init_vertexai()
+                    from vertexai.language_models import TextEmbeddingModel
+                    self._embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME)
+        return self._embedding_model
+
+    def embed(self, prompt: str) -> np.ndarray:
+        """Returns the unit-normalized embedding of a prompt."""
+        import numpy as np
+        values = np.asarray(self._get_embedding_model().get_embeddings([prompt])[0].values, dtype=np.float32)
+        return values / np.linalg.norm(values)
+
+    def lookup(self, embedding: np.ndarray, seed: int, negative_prompt: Optional[str]) -> Optional[Tuple[str, float]]:
+        """Returns the closest cached image path and its similarity, if it is similar enough."""
+        with self._lock:
+            embeddings, keys, paths = self._embeddings, list(self._keys), list(self._paths)
+        if embeddings is None:
+            return None
+        import numpy as np
+        similarities = embeddings @ embedding
+        key = (seed, negative_prompt or "")
+        for index in np.argsort(similarities)[::-1]:
+            if similarities[index] < self.threshold:
+                break
+            if keys[index] == key and os.path.isfile(paths[index]):
+                return paths[index], float(similarities[index])
+        return None
+
+    def add(self, embedding: np.ndarray, seed: int, negative_prompt: Optional[str], path: str):
+        """Records the image generated for an embedded prompt."""
+        import numpy as np
+        row = embedding[np.newaxis, :]
+        key = (seed, negative_prompt or "")
+        with self._lock:
+            self._embeddings = row if self._embeddings is None else np.vstack([self._embeddings, row])
+            self._keys.append(key)
+            self._key_set.add(key)
+            self._paths.append(path)
+
+    def record(
+        self,
+        prompt: str,
+        seed: int,
+        negative_prompt: Optional[str],
+        path: str,
+        embedding: Optional[np.ndarray] = None
+    ):
+        """
+        Records a generated image. Without a precomputed embedding the prompt is
+        embedded on a background thread, so the caller never waits on it.
+        """
+        if embedding is not None:
+            self.add(embedding, seed, negative_prompt, path)
+        else:
+            _submit_embedding(functools.partial(self._embed_and_add, prompt, seed, negative_prompt, path))
+
+    def _embed_and_add(self, prompt: str, seed: int, negative_prompt: Optional[str], path: str):
+        try:
+            self.add(self.embed(prompt), seed, negative_prompt, path)
+        except Exception:
+            pass  # The entry is simply not cached; the image itself was already saved.
+
+prompt_cache = PromptCache(SEMANTIC_CACHE_THRESHOLD)
+
+# Vertex AI is initialized on first use so read-only menu options start instantly.
+_model: Optional[ImageGenerationModel] = None
+_vertexai_initialized = False
+_init_lock = threading.RLock()
+
+def _init_vertexai(announce: bool = True):
+    """Initializes the Vertex AI SDK once, reusing a single set of ADC credentials."""
+    global _vertexai_initialized
+    with _init_lock:
+        if _vertexai_initialized:
+            return
+        if announce:
+            print(f"-> Initializing Vertex AI for project '{PROJECT_ID}' in '{LOCATION}'...")
+        try:
+            import google.auth
+            import vertexai
+            credentials, _ = google.auth.default()
+            vertexai.init(
+                project=PROJECT_ID,
+                location=LOCATION,
+                credentials=credentials,
+                api_transport=API_TRANSPORT,
+            )
+        except Exception as e:
+            raise RuntimeError(
+                f"Failed to initialize Vertex AI. Please check your configuration and authentication. ({e})"
+            ) from e
+        _vertexai_initialized = True
+
+def get_model(announce: bool = True) -> ImageGenerationModel:
+    """Returns the Imagen model, initializing Vertex AI and loading the model on first use."""
+    global _model
+    with _init_lock:
+        if _model is None:
+            _init_vertexai(announce)
+            from vertexai.preview.vision_models import ImageGenerationModel
+            _model = ImageGenerationModel.from_pretrained(MODEL_NAME)
+        return _model
+
+def warm_up_model():
+    """
+    Starts loading the Imagen model in a background thread, so Vertex AI init
+    and the first connection overlap with the user typing their prompt.
+    """
+    if _model is not None:
+        return
+
+    def _warm_up():
+        # Silent, as the user is typing at the prompt while this runs.
+        try:
+            get_model(announce=False)
+        except Exception:
+            pass  # The first real generation reports initialization errors.
+
+    threading.Thread(target=_warm_up, name="imagen-warmup", daemon=True).start()
+
+# One pool for all blocking Vertex AI calls, sized to the concurrency limit so
+# worker threads stay warm and batch mode cannot spawn unbounded threads.
+_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGEN_CONCURRENCY, thread_name_prefix="imagen")
+atexit.register(_EXECUTOR.shutdown, wait=True)
+
+# Generated images are embedded for the similar-prompt cache on a daemon thread,
+# so recording them never holds up a generation or the exit. The cache lives in
+# memory only, so embeddings still pending at exit are simply dropped.
+_embed_jobs: "queue.SimpleQueue[Callable[[], None]]" = queue.SimpleQueue()
+_embed_worker: Optional[threading.Thread] = None
+
+def _submit_embedding(job: Callable[[], None]):
+    """Queues a job for the embedding thread, starting the thread on first use."""
+    global _embed_worker
+    if _embed_worker is None:
+        def _run():
+            while True:
+                _embed_jobs.get()()
+
+        _embed_worker = threading.Thread(target=_run, name="embed", daemon=True)
+        _embed_worker.start()
+    _embed_jobs.put(job)
+
+_imagen_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def _save_session(characters_in_session: Dict[str, CharacterPackage]):
+    """Atomically writes the session's Character Packages to SESSION_FILE."""
+    data = msgpack.packb([
+        {
+            "name": char.name,
+            "description": char.description,
+            "seed": char.seed,
+            "negative_prompt": char.negative_prompt,
+            "portrait": char.portrait,
+        }
+        for char in characters_in_session.values()
+    ])
+    tmp_filename = f"{SESSION_FILE}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+    os.replace(tmp_filename, SESSION_FILE)
+
+def _load_session() -> Dict[str, CharacterPackage]:
+    """Loads the Character Packages saved by a previous run, if any."""
+    if not os.path.isfile(SESSION_FILE):
+        return {}
+    try:
+        with open(SESSION_FILE, "rb") as f:
+            records = msgpack.unpackb(f.read())
+        characters = [
+            CharacterPackage(r["name"], r["description"], r["seed"], r.get("negative_prompt"), r.get("portrait"))
+            for r in records
+        ]
+        return {session_key(char.name): char for char in characters}
+    except Exception as e:
+        print(f"!! Could not load the previous session from '{SESSION_FILE}': {e}")
+        return {}
+
+def _imagen_semaphore() -> asyncio.Semaphore:
+    """
+    Returns the semaphore limiting concurrent Imagen calls on the running loop.
+    Semaphores bind to a single event loop and each CLI stage runs its own.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _imagen_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _imagen_semaphores[loop] = asyncio.Semaphore(IMAGEN_CONCURRENCY)
+    return semaphore
+
+def _is_transient(error: BaseException) -> bool:
+    """Returns True for quota, availability and deadline errors worth retrying."""
+    from google.api_core.exceptions import DeadlineExceeded, ResourceExhausted, ServiceUnavailable
+    return isinstance(error, (ResourceExhausted, ServiceUnavailable, DeadlineExceeded))
+
+def _log_retry(retry_state):
+    error = retry_state.outcome.exception()
+    print(f"-> Transient Imagen error ({type(error).__name__}), retrying in {retry_state.next_action.sleep:.1f}s...")
+
+def _cache_path(
+    prompt: str,
+    seed: int,
+    negative_prompt: Optional[str],
+    aspect_ratio: str,
+    sample_count: int,
+    index: int
+) -> str:
+    """Returns the content-addressed cache path for one image of a request to MODEL_NAME."""
+    key = hashlib.sha256(
+        json.dumps(
+            [MODEL_NAME, prompt, seed, negative_prompt or "", aspect_ratio, sample_count, index], sort_keys=True
+        ).encode()
+    ).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.png")
+
+def _cache_lookup(
+    prompt: str,
+    seed: int,
+    negative_prompt: Optional[str],
+    aspect_ratio: str,
+    sample_count: int = 1
+) -> Optional[List[str]]:
+    """Returns the cached image paths for these parameters, or None unless all are cached."""
+    cached = [
+        _cache_path(prompt, seed, negative_prompt, aspect_ratio, sample_count, i)
+        for i in range(sample_count)
+    ]
+    if not all(os.path.isfile(path) for path in cached):
+        return None
+    # Touch the entries so pruning evicts the least recently used images first.
+    for path in cached:
+        os.utime(path)
+    return cached
+
+# This process is normally the cache's only writer, so the entry count is
+# tracked in memory after one initial scan instead of rescanning per store.
+_cache_entry_count: Optional[int] = None
+_cache_lock = threading.Lock()
+
+def _cache_store(
+    image_filenames: List[str],
+    prompt: str,
+    seed: int,
+    negative_prompt: Optional[str],
+    aspect_ratio: str
+) -> List[str]:
+    """Copies freshly generated images into the cache, prunes old entries and returns the cached paths."""
+    global _cache_entry_count
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cached = []
+    added = 0
+    for i, image_filename in enumerate(image_filenames):
+        path = _cache_path(prompt, seed, negative_prompt, aspect_ratio, len(image_filenames), i)
+        if not os.path.exists(path):
+            added += 1
+        # Copied under a temporary name and renamed into place, so an interrupted
+        # copy never leaves a truncated image behind to be served later.
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(image_filename, tmp_path)
+        os.replace(tmp_path, path)
+        cached.append(path)
+    with _cache_lock:
+        if _cache_entry_count is None:
+            _cache_entry_count = len(_scan_cache())
+        else:
+            _cache_entry_count += added
+        if _cache_entry_count > CACHE_MAX_ENTRIES:
+            _cache_entry_count = _prune_cache()
+    return cached
+
+def _scan_cache() -> List[os.DirEntry]:
+    """Returns the image entries currently in the cache directory."""
+    try:
+        with os.scandir(CACHE_DIR) as it:
+            return [entry for entry in it if entry.name.endswith(".png")]
+    except FileNotFoundError:
+        return []
+
+def _prune_cache() -> int:
+    """
+    Deletes the least recently used entries once the cache exceeds
+    CACHE_MAX_ENTRIES and returns the number of entries left.
+    """
+    entries = _scan_cache()
+    if len(entries) <= CACHE_MAX_ENTRIES:
+        return len(entries)
+    # Only stat the entries once pruning is actually needed.
+    mtimes = []
+    for entry in entries:
+        try:
+            mtimes.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            pass
+    mtimes.sort()
+    for _, path in mtimes[:len(mtimes) - CACHE_MAX_ENTRIES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return min(len(mtimes), CACHE_MAX_ENTRIES)
+
+def _write_image(image: Image, filename: str):
+    """
+    Saves an image to disk. Generated images go through `save`, which keeps their
+    generation parameters (prompt, seed, ...) as EXIF metadata; images without
+    them, such as cache restores, are written from their encoded bytes as-is.
+    """
+    data = getattr(image, "_image_bytes", None)
+    if data is None or getattr(image, "generation_parameters", None):
+        image.save(filename)
+        if FSYNC_IMAGES:
+            # A writable handle is required to fsync on Windows.
+            with open(filename, "r+b") as f:
+                os.fsync(f.fileno())
+        return
+    with open(filename, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(data)
+        if FSYNC_IMAGES:
+            f.flush()
+            os.fsync(f.fileno())
+
+def _restore_from_cache(cached: List[str], output_filenames: List[str]) -> List[Image]:
+    """
+    Restores cached images to their output paths, reading each cached file
+    once and building the returned image from the same bytes it writes.
+    """
+    from vertexai.preview.vision_models import Image
+    images = []
+    for path, filename in zip(cached, output_filenames):
+        with open(path, "rb") as f:
+            image = Image(image_bytes=f.read())
+        _write_image(image, filename)
+        images.append(image)
+    return images
+
+def _output_filenames(output_filename: str, sample_count: int) -> List[str]:
+    """Returns one output path per sample, numbering them when there is more than one."""
+    if sample_count == 1:
+        return [output_filename]
+    stem, ext = os.path.splitext(output_filename)
+    return [f"{stem}_{i+1}{ext}" for i in range(sample_count)]
+
+def _next_scene_filename(stem: str, reserved: Set[str] = frozenset()) -> str:
+    """
+    Returns the first scene filename for a character that would not overwrite an
+    earlier scene or reuse a name in `reserved` (assigned but not yet written).
+    """
+    for number in itertools.count(1):
+        output_filename = f"{stem}_scene_{number}.png"
+        if output_filename in reserved:
+            continue
+        candidates = [output_filename] + _output_filenames(output_filename, MAX_SAMPLE_COUNT)
+        if not any(os.path.exists(path) for path in candidates):
+            return output_filename
+
+async def generate_image_async(
     prompt: str,
     seed: int,
     negative_prompt: Optional[str] = None,
-    output_filename: str = "output.png"
-) -> Optional[Image]:
+    output_filename: str = "output.png",
+    sample_count: int = 1,
+    similar_prompts: bool = False
+) -> List[Image]:
     """
     Calls the Imagen API with parameters defined in the Functional Spec
-    and saves the generated image to a file.
+    and saves the generated images to files.
+
+    The SDK call is blocking, so it is dispatched to the shared Imagen thread
+    pool to let several generations overlap on the network. Up to
+    MAX_SAMPLE_COUNT images are returned by a single request; when more than
+    one is requested they are saved as `<stem>_<n><ext>`.
+
+    With `similar_prompts`, the image may be served from, and is recorded in,
+    the similar-prompt cache. Only scenes opt in, so a scene is never matched
+    to the portrait that shares its seed and description.
+
+    Raises ImagenError if the API returns no images; API and I/O errors
+    propagate unchanged so batch callers can report each failure.
     """
-    print(f"\n-> Generating image with seed: {seed}")
+    print(f"\n-> Generating {sample_count} image(s) with seed: {seed}")
     print(f"-> Prompt: {prompt}")
 
-    try:
-        # NOTE: The functional spec requires 'addWatermark: false' and no prompt
-        # enhancement to ensure the seed works for consistency. The Python SDK
-        # abstracts some of these parameters. This implementation assumes the SDK
-        # correctly handles seeded generation to maintain consistency.
-        response = model.generate_images(
-            prompt=prompt,
-            number_of_images=FIXED_SAMPLE_COUNT,
-            seed=seed,
-            aspect_ratio=FIXED_ASPECT_RATIO,
-            negative_prompt=negative_prompt,
-            # The 'person_generation' and 'language' parameters from the spec
-            # are often handled by SDK defaults or within the model itself.
+    if not 1 <= sample_count <= MAX_SAMPLE_COUNT:
+        raise ValueError(f"The number of images per request must be between 1 and {MAX_SAMPLE_COUNT}")
+    output_filenames = _output_filenames(output_filename, sample_count)
+
+    # Disk I/O goes to the loop's default pool so it neither blocks the event
+    # loop nor occupies a worker reserved for Imagen calls.
+    loop = asyncio.get_running_loop()
+    cached = _cache_lookup(prompt, seed, negative_prompt, FIXED_ASPECT_RATIO, sample_count)
+    if cached:
+        images = await loop.run_in_executor(None, _restore_from_cache, cached, output_filenames)
+        for filename in output_filenames:
+            print(f"-> Reused cached image, saved as '{filename}'")
+        return images
+
+    # Only a prompt whose seed and negative prompt already produced a recorded
+    # scene can match, so a character's first scene skips the embedding.
+    embedding = None
+    if similar_prompts and sample_count == 1 and prompt_cache.has_entries(seed, negative_prompt):
+        try:
+            embedding = await loop.run_in_executor(None, prompt_cache.embed, prompt)
+        except Exception as e:
+            print(f"-> Skipping similar-prompt cache, embedding failed: {e}")
+    if embedding is not None:
+        match = prompt_cache.lookup(embedding, seed, negative_prompt)
+        if match:
+            path, similarity = match
+            images = await loop.run_in_executor(None, _restore_from_cache, [path], output_filenames)
+            print(f"-> Reused cached image of a similar prompt (similarity {similarity:.2f}), saved as '{output_filename}'")
+            return images
+
+    model = await loop.run_in_executor(_EXECUTOR, get_model)
+
+    # NOTE: The functional spec requires 'addWatermark: false' and no prompt
+    # enhancement to ensure the seed works for consistency. The Python SDK
+    # abstracts some of these parameters. This implementation assumes the SDK
+    # correctly handles seeded generation to maintain consistency.
+    async with _imagen_semaphore():
+        async for attempt in AsyncRetrying(
+            wait=wait_exponential(multiplier=1, max=30) + wait_random(0, 1),
+            retry=retry_if_exception(_is_transient),
+            stop=stop_after_attempt(IMAGEN_MAX_ATTEMPTS),
+            before_sleep=_log_retry,
+            reraise=True,
+        ):
+            with attempt:
+                response = await loop.run_in_executor(
+                    _EXECUTOR,
+                    functools.partial(
+                        model.generate_images,
+                        prompt=prompt,
+                        number_of_images=sample_count,
+                        seed=seed,
+                        aspect_ratio=FIXED_ASPECT_RATIO,
+                        negative_prompt=negative_prompt,
+                        # The 'person_generation' and 'language' parameters from the spec
+                        # are often handled by SDK defaults or within the model itself.
+                    )
+                )
+    images = list(response.images)
+    if not images:
+        raise ImagenError("The API returned no images; the prompt may have been blocked by safety filters")
+    saved_filenames = output_filenames[:len(images)]
+    await asyncio.gather(*(
+        loop.run_in_executor(None, _write_image, image, filename)
+        for image, filename in zip(images, saved_filenames)
+    ))
+    for filename in saved_filenames:
+        print(f"-> Image saved successfully as '{filename}'")
+    # Responses with fewer images than requested (e.g. safety-filtered) are not cached.
+    if len(images) == sample_count:
+        cached = await loop.run_in_executor(
+            None, _cache_store, saved_filenames, prompt, seed, negative_prompt, FIXED_ASPECT_RATIO
         )
-        image = response.images[0]
-        image.save(output_filename)
-        print(f"-> Image saved successfully as '{output_filename}'")
-        return image
+        if similar_prompts and sample_count == 1 and prompt_cache.enabled:
+            prompt_cache.record(prompt, seed, negative_prompt, cached[0], embedding)
+    return images
+
+def generate_image(
+    prompt: str,
+    seed: int,
+    negative_prompt: Optional[str] = None,
+    output_filename: str = "output.png",
+    sample_count: int = 1
+) -> List[Image]:
+    """Synchronous wrapper around `generate_image_async`."""
+    return asyncio.run(generate_image_async(prompt, seed, negative_prompt, output_filename, sample_count))
+
+def try_generate_image(
+    prompt: str,
+    seed: int,
+    negative_prompt: Optional[str] = None,
+    output_filename: str = "output.png",
+    sample_count: int = 1
+) -> Optional[List[Image]]:
+    """Like `generate_image`, but reports errors to the user and returns None instead of raising."""
+    try:
+        return generate_image(prompt, seed, negative_prompt, output_filename, sample_count)
     except Exception as e:
         print(f"!! An error occurred during image generation: {e}")
         return None
 
-def create_character(characters_in_session: List[CharacterPackage]):
-    """Stage 1: Character Definition & Seeding."""
-    print("\n--- Create New Character ---")
-    name = input("Enter a name for this character: ")
-    print("Enter a detailed character description (physical appearance, clothing, etc.). Press Ctrl+D (or Ctrl+Z on Windows) when done.")
-    description_lines = []
+async def generate_images_batch(
+    jobs: List[Tuple[str, int, Optional[str], str]]
+) -> List[Union[List[Image], Exception]]:
+    """
+    Generates several images concurrently.
+
+    Each job is a `(prompt, seed, negative_prompt, output_filename)` tuple. Results
+    are returned in the same order as the jobs; a failed job yields its exception
+    without cancelling the others.
+    """
+    return await asyncio.gather(
+        *(
+            generate_image_async(prompt, seed, negative_prompt, output_filename)
+            for prompt, seed, negative_prompt, output_filename in jobs
+        ),
+        return_exceptions=True,
+    )
+
+async def generate_scenes_batch(
+    character: CharacterPackage,
+    scene_descriptions: List[str],
+    takes: int = 1
+) -> List[Union[List[Image], Exception]]:
+    """
+    Generates one scene per description for a character, concurrently. The
+    Imagen semaphore bounds how many requests are in flight; a single scene is
+    simply a batch of one. Results are returned in description order, with the
+    exception in place of any scene that failed.
+    """
+    stem = character.safe_name
+    assigned: Set[str] = set()
+    jobs = []
+    for scene_description in scene_descriptions:
+        # 1. Construct the combined prompt.
+        stage2_prompt = character.scene_prefix + scene_description.strip()
+        # 2. Reserve an output name so concurrent scenes never share one.
+        output_filename = _next_scene_filename(stem, assigned)
+        assigned.add(output_filename)
+        jobs.append((stage2_prompt, output_filename))
+
+    # 3. Generate the images using the character's seed.
+    return await asyncio.gather(
+        *(
+            generate_image_async(
+                stage2_prompt, character.seed, character.negative_prompt, output_filename, takes, similar_prompts=True
+            )
+            for stage2_prompt, output_filename in jobs
+        ),
+        return_exceptions=True,
+    )
+
+async def buffered(iterator: AsyncIterator[T], size: int) -> AsyncIterator[T]:
+    """
+    Re-yields items from an async iterator while a background task reads up to
+    `size` items ahead, so the producer keeps running while the consumer works.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+
+    async def fill():
+        try:
+            async for item in iterator:
+                await queue.put((item, None))
+            await queue.put((None, StopAsyncIteration()))
+        except Exception as e:
+            await queue.put((None, e))
+
+    filler = asyncio.create_task(fill())
+    try:
+        while True:
+            item, error = await queue.get()
+            if isinstance(error, StopAsyncIteration):
+                return
+            if error is not None:
+                raise error
+            yield item
+    finally:
+        filler.cancel()
+
+def _read_multiline_tty() -> str:
+    """Reads lines from the terminal until Ctrl+D (or Ctrl+Z on Windows) is pressed."""
+    lines = []
     while True:
         try:
             line = input()
-            description_lines.append(line)
+            lines.append(line)
         except EOFError:
             break
-    description = "\n".join(description_lines)
+    return "\n".join(lines)
+
+def _read_multiline_stream() -> str:
+    """
+    Reads piped input up to a blank line or the end of input. Stopping at a
+    blank line lets a script (`python main.py < script.txt`) carry the answers
+    for later prompts after the description.
+    """
+    lines = []
+    for line in iter(sys.stdin.readline, ""):
+        line = line.rstrip("\n")
+        if not line:
+            break
+        lines.append(line)
+    return "\n".join(lines)
+
+def read_multiline_input() -> str:
+    """Reads a multi-line block of text from the terminal or from piped input."""
+    return _read_multiline_tty() if sys.stdin.isatty() else _read_multiline_stream()
+
+def create_character(characters_in_session: Dict[str, CharacterPackage]):
+    """Stage 1: Character Definition & Seeding."""
+    print("\n--- Create New Character ---")
+    name = input("Enter a name for this character: ").strip()
+    valid, error = validate_character_name(name)
+    if not valid:
+        print(f"!! {error}. Character creation cancelled.")
+        return
+    if session_key(name) in characters_in_session:
+        print(f"!! A character named '{name}' already exists. Character creation cancelled.")
+        return
+    warm_up_model()
+    print("Enter a detailed character description (physical appearance, clothing, etc.). Press Ctrl+D (or Ctrl+Z on Windows) when done.")
+    description = read_multiline_input()
 
     if not description:
         print("!! Description cannot be empty. Character creation cancelled.")
@@ -91,89 +792,245 @@ def create_character(characters_in_session: List[CharacterPackage]):
     negative_prompt = input("Enter a negative prompt (optional, what to avoid): ")
 
     # 1. Generate a random non-negative integer for the seed.
-    seed = random.randint(0, 2**32 - 1)
+    seed = secrets.randbits(32)
 
-    # 2. Construct the prompt with quality modifiers.
-    stage1_prompt = f"cinematic portrait, high detail, studio lighting. {description}"
+    # 2. Create the Character Package, which builds the prompt with quality modifiers.
+    package = CharacterPackage(name, description, seed, negative_prompt)
 
     # 3. Generate the image.
-    output_filename = f"{name.replace(' ', '_')}_portrait.png"
-    if generate_image(stage1_prompt, seed, negative_prompt, output_filename):
-        # 4. Create and store the Character Package.
-        package = CharacterPackage(name, description, seed, negative_prompt)
-        characters_in_session.append(package)
+    if try_generate_image(package.stage1_prompt, seed, negative_prompt, package.portrait):
+        # 4. Store the Character Package.
+        characters_in_session[session_key(name)] = package
+        _save_session(characters_in_session)
         print(f"\n++ Character '{name}' created and saved. You can now use this character in scenes.")
 
-def generate_scene(characters_in_session: List[CharacterPackage]):
-    """Stage 2: Scene Generation."""
+async def character_definitions(taken_names: Set[str]) -> AsyncIterator[Tuple[str, str, str]]:
+    """
+    Yields (name, description, negative_prompt) tuples until the user enters an
+    empty name or ends the input. Names already in `taken_names` are rejected;
+    yielded names are added to it.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        # Blocking reads run in a worker thread so pending generations keep progressing.
+        try:
+            name = (await loop.run_in_executor(None, input, "\nEnter a name for the next character (leave empty to finish): ")).strip()
+        except EOFError:
+            return
+        if not name:
+            return
+        valid, error = validate_character_name(name)
+        if not valid:
+            print(f"!! {error}. Skipping this character.")
+            continue
+        if session_key(name) in taken_names:
+            print(f"!! A character named '{name}' already exists. Skipping this character.")
+            continue
+        print("Enter a detailed character description (physical appearance, clothing, etc.). Press Ctrl+D (or Ctrl+Z on Windows) when done.")
+        description = await loop.run_in_executor(None, read_multiline_input)
+        if not description:
+            print("!! Description cannot be empty. Skipping this character.")
+            continue
+        try:
+            negative_prompt = await loop.run_in_executor(None, input, "Enter a negative prompt (optional, what to avoid): ")
+        except EOFError:
+            negative_prompt = ""
+        taken_names.add(session_key(name))
+        yield name, description, negative_prompt
+
+async def _create_characters_pipelined(characters_in_session: Dict[str, CharacterPackage]):
+    """Starts each portrait generation as soon as its definition is entered."""
+    pending = []
+    try:
+        async for name, description, negative_prompt in buffered(character_definitions(set(characters_in_session)), 2):
+            seed = secrets.randbits(32)
+            package = CharacterPackage(name, description, seed, negative_prompt)
+            task = asyncio.create_task(generate_image_async(package.stage1_prompt, seed, negative_prompt, package.portrait))
+            pending.append((task, package))
+    finally:
+        # Portraits already in flight are kept even if reading the next definition fails.
+        for task, package in pending:
+            try:
+                await task
+            except Exception as e:
+                print(f"!! Character '{package.name}' could not be created: {e}")
+                continue
+            characters_in_session[session_key(package.name)] = package
+            print(f"++ Character '{package.name}' created and saved.")
+        _save_session(characters_in_session)
+
+def create_characters_batch(characters_in_session: Dict[str, CharacterPackage]):
+    """Stage 1 (batch): Portraits generate in the background while the next character is typed."""
+    print("\n--- Create Multiple Characters ---")
+    asyncio.run(_create_characters_pipelined(characters_in_session))
+
+def create_character_variants(characters_in_session: Dict[str, CharacterPackage]):
+    """Stage 1 (variants): Generates N candidate portraits concurrently and keeps the chosen one."""
+    print("\n--- Generate Character Variants ---")
+    name = input("Enter a name for this character: ").strip()
+    valid, error = validate_character_name(name)
+    if not valid:
+        print(f"!! {error}. Variant generation cancelled.")
+        return
+    if session_key(name) in characters_in_session:
+        print(f"!! A character named '{name}' already exists. Variant generation cancelled.")
+        return
+    try:
+        count = int(input("How many variants should be generated? "))
+        if count < 1:
+            raise ValueError
+    except ValueError:
+        print("!! Invalid number of variants. Variant generation cancelled.")
+        return
+    warm_up_model()
+    print("Enter a detailed character description (physical appearance, clothing, etc.). Press Ctrl+D (or Ctrl+Z on Windows) when done.")
+    description = read_multiline_input()
+
+    if not description:
+        print("!! Description cannot be empty. Variant generation cancelled.")
+        return
+
+    negative_prompt = input("Enter a negative prompt (optional, what to avoid): ")
+
+    # Each variant gets its own seed; the chosen one becomes the character's seed.
+    stage1_prompt = portrait_prompt(description)
+    stem = file_stem(name)
+    jobs = [
+        (stage1_prompt, secrets.randbits(32), negative_prompt, f"{stem}_variant_{i+1}.png")
+        for i in range(count)
+    ]
+    results = asyncio.run(generate_images_batch(jobs))
+
+    succeeded = []
+    for job, result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print(f"!! Variant '{job[3]}' could not be generated: {result}")
+        else:
+            succeeded.append((job, result))
+    if not succeeded:
+        print("!! No variants were generated. Character creation cancelled.")
+        return
+
+    print("\n--- Generated Variants ---")
+    for i, (job, _) in enumerate(succeeded):
+        print(f"[{i+1}] {job[3]} (seed: {job[1]})")
+    try:
+        choice = int(input("Select the number of the variant to keep: ")) - 1
+        if not 0 <= choice < len(succeeded):
+            raise ValueError
+    except ValueError:
+        print("!! Invalid selection. Character creation cancelled.")
+        return
+
+    _, seed, _, portrait = succeeded[choice][0]
+    package = CharacterPackage(name, description, seed, negative_prompt, portrait)
+    characters_in_session[session_key(name)] = package
+    _save_session(characters_in_session)
+    print(f"\n++ Character '{name}' created with seed {seed}. You can now use this character in scenes.")
+
+def find_character(characters_in_session: Dict[str, CharacterPackage], selection: str) -> Optional[CharacterPackage]:
+    """Finds a character by its list number, its name, or part of its name."""
+    selection = selection.strip()
+    if selection.isdigit():
+        index = int(selection) - 1
+        if 0 <= index < len(characters_in_session):
+            return list(characters_in_session.values())[index]
+        return None
+    key = session_key(selection)
+    if not key:
+        return None
+    if key in characters_in_session:
+        return characters_in_session[key]
+    return next((char for name, char in characters_in_session.items() if key in name), None)
+
+def generate_scene(characters_in_session: Dict[str, CharacterPackage], queue_size: int = 0):
+    """
+    Stage 2: Scene Generation. With a `queue_size`, up to that many scene
+    descriptions are collected before they are dispatched together; an empty
+    description dispatches the ones collected so far.
+    """
     print("\n--- Generate New Scene ---")
     if not characters_in_session:
         print("!! No characters have been created in this session. Please create a character first.")
         return
 
     list_characters(characters_in_session)
+    selection = input("Select the character to use in the scene (number or name): ")
+    selected_char = find_character(characters_in_session, selection)
+    if selected_char is None:
+        print("!! Invalid selection. Scene generation cancelled.")
+        return
+
+    # Takes share the character's seed, so they are requested together in one
+    # call rather than as separate (identical) requests.
+    takes_input = input(f"How many takes of each scene? (1-{MAX_SAMPLE_COUNT}, default 1): ")
     try:
-        char_index = int(input("Select the number of the character to use in the scene: ")) - 1
-        if not 0 <= char_index < len(characters_in_session):
+        takes = int(takes_input) if takes_input else 1
+        if not 1 <= takes <= MAX_SAMPLE_COUNT:
             raise ValueError
-        selected_char = characters_in_session[char_index]
-    except (ValueError, IndexError):
-        print("!! Invalid selection. Scene generation cancelled.")
+    except ValueError:
+        print("!! Invalid number of takes. Scene generation cancelled.")
         return
+    warm_up_model()
 
-    print("Enter a description for the scene (action, environment, etc.). Press Ctrl+D (or Ctrl+Z on Windows) when done.")
-    scene_lines = []
+    # Several scenes can be queued; they are generated concurrently afterwards.
+    scene_descriptions = []
     while True:
-        try:
-            line = input()
-            scene_lines.append(line)
-        except EOFError:
+        if queue_size:
+            print(f"Scene {len(scene_descriptions) + 1} of {queue_size}.")
+        print("Enter a description for the scene (action, environment, etc.). Press Ctrl+D (or Ctrl+Z on Windows) when done.")
+        scene_description = read_multiline_input()
+        if not scene_description:
+            print("!! Scene description cannot be empty.")
+            break
+        scene_descriptions.append(scene_description)
+        if queue_size:
+            if len(scene_descriptions) >= queue_size:
+                break
+        elif input("Queue another scene for this character? (y/N): ").strip().lower() != "y":
             break
-    scene_description = "\n".join(scene_lines)
 
-    if not scene_description:
-        print("!! Scene description cannot be empty. Scene generation cancelled.")
+    if not scene_descriptions:
+        print("!! No scene was described. Scene generation cancelled.")
         return
 
-    # 1. Construct the combined prompt.
-    stage2_prompt = f"{selected_char.description}. {scene_description}"
-
-    # 2. Generate the image using the character's seed.
-    output_filename = f"{selected_char.name.replace(' ', '_')}_scene_{random.randint(100,999)}.png"
-    generate_image(
-        stage2_prompt,
-        selected_char.seed,
-        selected_char.negative_prompt,
-        output_filename
-    )
+    results = asyncio.run(generate_scenes_batch(selected_char, scene_descriptions, takes))
+    failures = [result for result in results if isinstance(result, Exception)]
+    for error in failures:
+        print(f"!! A scene could not be generated: {error}")
+    if len(results) > 1:
+        print(f"\n++ {len(results) - len(failures)} of {len(results)} scene(s) generated.")
 
-def list_characters(characters_in_session: List[CharacterPackage]):
+def list_characters(characters_in_session: Dict[str, CharacterPackage]):
     """Lists all characters created in the current session."""
     print("\n--- Available Characters ---")
     if not characters_in_session:
         print("No characters created yet.")
     else:
-        for i, char in enumerate(characters_in_session):
+        for i, char in enumerate(characters_in_session.values()):
             print(f"[{i+1}] {char}")
     print("--------------------------")
 
 def main():
     """Main function to run the CineGen CLI."""
+    parser = argparse.ArgumentParser(description="Generate consistent characters and scenes with Imagen.")
+    parser.add_argument(
+        "--queue",
+        type=int,
+        default=0,
+        metavar="N",
+        help="collect N scene descriptions per scene generation and generate them concurrently",
+    )
+    args = parser.parse_args()
+    if args.queue < 0:
+        parser.error("--queue cannot be negative")
+
     print("--- Welcome to CineGen (CLI Version) ---")
     print("This tool uses Google's Imagen model to generate consistent characters.")
-    print(f"Initializing Vertex AI for project '{PROJECT_ID}' in '{LOCATION}'...")
 
-    try:
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        global model
-        model = ImageGenerationModel.from_pretrained(MODEL_NAME)
-        print("Vertex AI initialized successfully.")
-    except Exception as e:
-        print(f"!! Failed to initialize Vertex AI. Please check your configuration and authentication.")
-        print(f"!! Error: {e}")
-        return
-
-    characters_in_session: List[CharacterPackage] = []
+    characters_in_session: Dict[str, CharacterPackage] = _load_session()
+    if characters_in_session:
+        print(f"Restored {len(characters_in_session)} character(s) from the previous session.")
 
     while True:
         print("\n" + "="*15 + " Main Menu " + "="*15)
@@ -181,17 +1038,26 @@ def main():
         print("2. Generate Scene with Character (Stage 2)")
         print("3. List Created Characters")
         print("4. Exit")
-        choice = input("> ")
+        print("5. Create Multiple Characters (Stage 1)")
+        print("6. Generate N Character Variants (Stage 1)")
+        try:
+            choice = input("> ")
+        except EOFError:
+            choice = '4'
 
         if choice == '1':
             create_character(characters_in_session)
         elif choice == '2':
-            generate_scene(characters_in_session)
+            generate_scene(characters_in_session, args.queue)
         elif choice == '3':
             list_characters(characters_in_session)
         elif choice == '4':
             print("Exiting CineGen. Goodbye!")
             break
+        elif choice == '5':
+            create_characters_batch(characters_in_session)
+        elif choice == '6':
+            create_character_variants(characters_in_session)
         else:
             print("!! Invalid choice, please try again.")
 